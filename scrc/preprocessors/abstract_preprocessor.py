@@ -1,24 +1,35 @@
 from datetime import datetime
-import gc
+import functools
 import importlib
 import json
 import multiprocessing
 import os
 from collections import Counter, Sized
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
 import glob
-from time import sleep
+from itertools import chain, islice
 
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import spacy
+from spacy.attrs import LEMMA, POS, TAG
 from spacy.lang.de import German
 from spacy.lang.fr import French
 from spacy.lang.it import Italian
-from spacy.tokens import Doc
+from spacy.tokens import DocBin
+from spacy.symbols import NUM, PUNCT, SYM, X
 from spacy.vocab import Vocab
+from thinc.api import set_gpu_allocator
 from tqdm import tqdm
 from transformers import AutoTokenizer
 
 from root import ROOT_DIR
+from scrc.utils.main_utils import get_num_cpus, prefetch, trim_memory
+from scrc.utils.doc_cache import DocCache
+from scrc.utils.spacy_worker import doc_bin_attrs, init_worker, process_batch, pipe_batch, set_pretokenizer
 import pandas as pd
 
 from sqlalchemy.sql.expression import bindparam
@@ -61,6 +72,10 @@ class AbstractPreprocessor:
         self.wikipedia_spacy_subdir = self.create_dir(self.wikipedia_subdir, config['dir']['spacy_subdir'])
         self.spider_specific_dir = self.create_dir(ROOT_DIR, config['dir']['spider_specific_dir'])
         self.output_dir = self.create_dir(self.data_dir, config['dir']['output_subdir'])
+        # caches the docs of recurring texts across all parts (the key contains the model, so it can be shared)
+        self.spacy_doc_cache_path = None
+        if config.getboolean('spacy', 'doc_cache'):
+            self.spacy_doc_cache_path = self.spacy_subdir / "_doc_cache.sqlite"
 
         self.ip = config['postgres']['ip']
         self.port = config['postgres']['port']
@@ -73,7 +88,25 @@ class AbstractPreprocessor:
 
         self.indexes = json.loads(config['postgres']['indexes'])
 
-        self.num_cpus = multiprocessing.cpu_count()
+        self.num_cpus = get_num_cpus()
+
+        # can be overridden with the env variables SCRC_SPACY_N_PROCESS and SCRC_SPACY_BATCH_SIZE
+        self.spacy_n_process = int(os.environ.get('SCRC_SPACY_N_PROCESS', config['spacy']['n_process']))
+        if self.spacy_n_process < 1:  # -1 means all but one of the available cpus
+            self.spacy_n_process = max(1, self.num_cpus - 1)
+        self.spacy_batch_size = int(os.environ.get('SCRC_SPACY_BATCH_SIZE', config['spacy']['batch_size']))
+        # for short texts the ipc overhead of the workers outweighs the gain of running them in parallel
+        self.spacy_serial_max_mean_length = 2000  # in characters
+        self.spacy_serial_batch_size = 128
+        # the huggingface pre tokenizer is faster but splits the tokens differently than the spacy tokenizer
+        self.spacy_pretokenize = config.getboolean('spacy', 'pretokenize')
+        self.spacy_gpu = config.getboolean('spacy', 'gpu')
+        self.spacy_gpu_batch_size = int(config['spacy']['gpu_batch_size'])
+        # tag, pos and lemma are enough for now: the parser is by far the most expensive component and not needed
+        # the morphologizer must stay because it predicts the pos tags (needed by the rule based lemmatizers too)
+        self.disable_pipes = ['parser', 'senter', 'ner', 'attribute_ruler', 'textcat']
+        # increase max length for long texts: Can lead to memory allocation errors for parser and ner
+        self.spacy_max_length = 3000000
 
         self.stopwords = stopwords(self.languages)
         # this should be filtered out by PUNCT pos tag already, but sometimes they are misclassified
@@ -81,6 +114,19 @@ class AbstractPreprocessor:
 
         self.counter_types = ['counter_lemma', 'counter_pos', 'counter_tag']
 
+        # the spacy docs are processed in batches of this size (one task per batch for the workers)
+        # and packed into DocBins which are appended to one docs.spacy file per part.
+        # The index.parquet next to it stores where (offset and length of the DocBin, position inside it) each doc is
+        self.spacy_doc_bin_size = 256
+        self.spacy_index_schema = pa.schema([('id', pa.int64()), ('offset', pa.int64()), ('length', pa.int64()),
+                                             ('position', pa.int32())])
+        # the offset and length repeat for all docs of a DocBin and the positions are small, so they get a dictionary
+        self.spacy_index_parquet_options = dict(compression='zstd', compression_level=3,
+                                                use_dictionary=['offset', 'length', 'position'])
+        # the index is buffered and written in big row groups, since many tiny row groups make reading very slow
+        self.spacy_index_row_group_size = 65536
+        self.spacy_docs_index = {}  # maps the spacy dirs to the location (path, offset, length, position) of each doc
+
     @staticmethod
     def create_dir(parent_dir: Path, dir_name: str) -> Path:
         dir = parent_dir / dir_name
@@ -172,6 +218,12 @@ class AbstractPreprocessor:
             for chunk_df in pd.read_sql(query, conn, chunksize=chunksize):
                 yield chunk_df
 
+    @staticmethod
+    @functools.lru_cache()
+    def get_user_output_dir(output_dir: Path) -> Path:
+        """Creates the output dir of the current user only once instead of for every updated chunk"""
+        return AbstractPreprocessor.create_dir(output_dir, os.getlogin())
+
     @staticmethod
     def update(engine, df: pd.DataFrame, table: str, columns: list, output_dir: Path):
         """
@@ -184,8 +236,8 @@ class AbstractPreprocessor:
         """
 
         if not AbstractPreprocessor._check_write_privilege(engine):
-            AbstractPreprocessor.create_dir(output_dir, os.getlogin())
-            path = Path.joinpath(output_dir, os.getlogin(), datetime.now().isoformat() + '.json')
+            user_output_dir = AbstractPreprocessor.get_user_output_dir(output_dir)
+            path = user_output_dir / (datetime.now().isoformat() + '.json')
             with path.open("a") as f:
                 df.to_json(f)
             return
@@ -198,53 +250,186 @@ class AbstractPreprocessor:
             query = t.update().where(t.c.id == bindparam('b_id')).values()
             conn.execute(query, df.to_dict('records'))  # bulk update
 
-    @staticmethod
-    def load_vocab(spacy_dir) -> Vocab:
-        vocab_path = spacy_dir / f"_vocab.spacy"
-        if vocab_path.exists():
-            return Vocab().from_disk(str(vocab_path), exclude=['vectors'])
-
-    @staticmethod
-    def save_vocab(vocab, spacy_dir) -> None:
-        vocab.to_disk(spacy_dir / f"_vocab.spacy", exclude=['vectors'])
-
-    def run_nlp_pipe(self, engine, table, spacy_dir, where, nlp, bert_tokenizer, logger):
+    def load_spacy_model(self, model_name, logger):
+        if self.spacy_gpu:
+            if spacy.prefer_gpu():  # falls back to the cpu if no gpu is available
+                set_gpu_allocator("pytorch")  # reuses the cached memory across the loaded models
+                # multiple processes do not work with the gpu, so we need big batches to keep the gpu busy instead
+                self.spacy_n_process = 1
+                self.spacy_batch_size = self.spacy_gpu_batch_size
+                logger.info(f"Running spacy on the gpu with batch_size={self.spacy_batch_size}")
+            else:
+                logger.warning("No gpu available for spacy. Falling back to the cpu")
+        nlp = spacy.load(model_name, disable=self.disable_pipes)
+        nlp.max_length = self.spacy_max_length
+        if self.spacy_pretokenize:
+            set_pretokenizer(nlp)
+        logger.info(f"Loaded spacy model {model_name} with the pipes {nlp.pipe_names}")
+        return nlp
+
+    def create_spacy_pool(self, model_name, bert_tokenizer, logger):
+        """
+        Creates a pool of workers which load the spacy model only once and can be reused for all the parts of a language.
+        Returns an empty context if the pipeline runs in a single process (e.g. on the gpu).
+        :param model_name:      the spacy model loaded by the workers
+        :param bert_tokenizer:  used for computing the number of bert tokens if present
+        :param logger:          custom logger for info output
+        :return:
         """
-        Runs the spacy pipe on the table provided and saves the docs into the given folder
+        if self.spacy_n_process == 1:
+            return nullcontext()
+        logger.info(f"Starting a pool of {self.spacy_n_process} spacy workers")
+        initargs = (model_name, self.disable_pipes, self.spacy_max_length, bert_tokenizer, self.spacy_batch_size,
+                    self.spacy_pretokenize, self.spacy_doc_cache_path)
+        return multiprocessing.Pool(self.spacy_n_process, initializer=init_worker, initargs=initargs,
+                                    maxtasksperchild=32)  # recycle the workers to bound their memory growth
+
+    def run_nlp_pipe(self, engine, table, spacy_dir, name, where, nlp, bert_tokenizer, logger, pool=None):
+        """
+        Runs the spacy pipe on the table provided and saves the docs into a docs.spacy file (with an index.parquet)
         :param engine:      the engine with the db connection
         :param table:       where to get the data from and to save it to
         :param spacy_dir:   where to save the docs obtained
+        :param name:        the name of the folder inside the spacy_dir the docs are saved to
         :param where:       how to select the dfs
-        :param nlp:         used for creating the docs
+        :param nlp:         used for creating the docs if no pool is given
         :param bert_tokenizer: used for computing the number of bert tokens if present
         :param logger:      custom logger for info output
+        :param pool:        the pool of spacy workers (see create_spacy_pool), if None the pipe runs in this process
         :return:
         """
-        dfs = self.select(engine, table, columns='id, text', where=where)  # stream dfs from the db
-        for df in dfs:
-            df = df[['text', 'id']]  # reorder the df so that we get the text first and the id after
-            tuples = list(df.itertuples(index=False))  # convert df to list of tuples
-            # batch_size = max(int(len(texts) / self.num_cpus), 1) # a high batch_size can lead to lots of allocated memory
-            docs = tqdm(nlp.pipe(tuples, n_process=-1, batch_size=1, as_tuples=True), total=len(tuples))
-            num_tokens = []
-            logger.info("Saving spacy docs to disk")
-            for doc, id in docs:
-                path = spacy_dir / (str(id) + ".spacy")
-                doc.to_disk(path, exclude=['tensor'])  # this makes the space on the disk much smaller!
-                num_tokens.append(len(doc))
-            df['num_tokens_spacy'] = num_tokens
-
-            if bert_tokenizer:
-                df['num_tokens_bert'] = [len(input_id) for input_id in bert_tokenizer(df['text'].tolist()).input_ids]
-
-            columns = ['num_tokens_spacy', 'num_tokens_bert']
-            logger.info("Saving num_tokens_spacy and num_tokens_bert to db")
-            self.update(engine, df, table, columns, self.output_dir)
-
-            self.save_vocab(nlp.vocab, spacy_dir)
-
-            gc.collect()
-            sleep(2)  # sleep(2) is required to allow measurement of the garbage collector
+        # stream dfs from the db in a background thread so that the reading overlaps with the spacy pipe
+        dfs = prefetch(self.select(engine, table, columns='id, text', where=where))
+        first_df = next(dfs, None)
+        batch_size = self.spacy_batch_size
+        if pool and first_df is not None:
+            # the first df is a cheap sample of the text lengths (an avg over all the texts would read the whole table)
+            mean_length = first_df.text.str.len().mean()
+            if mean_length < self.spacy_serial_max_mean_length:
+                logger.info(f"The texts are short (mean length {mean_length:.0f} characters), "
+                            f"so the pool is not worth the ipc overhead")
+                pool = None
+                batch_size = self.spacy_serial_batch_size
+        dfs = chain([first_df], dfs) if first_df is not None else dfs
+        rows = (row for df in dfs for row in df[['id', 'text']].itertuples(index=False))
+        # (ids, texts) batches of the size of one DocBin
+        batches = (tuple(zip(*batch)) for batch in iter(lambda: list(islice(rows, self.spacy_doc_bin_size)), []))
+        doc_cache = None  # the workers of the pool open their own connection to the cache
+        if pool:
+            logger.info(f"Running spacy pipe in the pool with batch_size={self.spacy_batch_size}")
+            results = pool.imap_unordered(process_batch, batches)
+        else:
+            logger.info(f"Running spacy pipe in a single process with batch_size={batch_size}")
+            if self.spacy_doc_cache_path:
+                model_version = DocCache.get_model_version(nlp, self.spacy_pretokenize)
+                doc_cache = DocCache(self.spacy_doc_cache_path, model_version, doc_bin_attrs)
+            results = (pipe_batch(nlp, bert_tokenizer, ids, texts, batch_size, doc_cache)
+                       for ids, texts in batches)
+
+        part_dir = self.create_dir(spacy_dir, name)
+        logger.info(f"Saving spacy docs to {part_dir}")
+        with (part_dir / "docs.spacy").open("wb") as docs_file, \
+                pq.ParquetWriter(part_dir / "index.parquet", self.spacy_index_schema,
+                                 **self.spacy_index_parquet_options) as index_writer, \
+                ThreadPoolExecutor(max_workers=1) as write_executor:
+            # the docs are written in a background thread while the next batch is being processed
+            pending_write = None
+            index_tables = []  # buffer of the index until it fills a row group
+            ids, num_tokens_spacy, num_tokens_bert = [], [], []
+            for batch_ids, batch_num_tokens_spacy, batch_num_tokens_bert, doc_bin_bytes in tqdm(results):
+                if pending_write:
+                    pending_write.result()  # keep only one batch in flight and raise the errors of the writer
+                pending_write = write_executor.submit(self.write_docs, docs_file, index_writer, index_tables,
+                                                      batch_ids, doc_bin_bytes)
+                ids.extend(batch_ids)
+                num_tokens_spacy.extend(batch_num_tokens_spacy)
+                num_tokens_bert.extend(batch_num_tokens_bert)
+                if len(ids) >= self.chunksize:
+                    self.save_num_tokens(engine, table, ids, num_tokens_spacy, num_tokens_bert, logger)
+                    ids, num_tokens_spacy, num_tokens_bert = [], [], []
+            if pending_write:
+                pending_write.result()
+            self.flush_index(index_writer, index_tables)
+            if ids:
+                self.save_num_tokens(engine, table, ids, num_tokens_spacy, num_tokens_bert, logger)
+        if doc_cache:
+            doc_cache.close()
+        trim_memory()
+
+    def save_num_tokens(self, engine, table, ids, num_tokens_spacy, num_tokens_bert, logger) -> None:
+        df = pd.DataFrame({'id': ids, 'num_tokens_spacy': num_tokens_spacy, 'num_tokens_bert': num_tokens_bert})
+        columns = ['num_tokens_spacy', 'num_tokens_bert']
+        logger.info("Saving num_tokens_spacy and num_tokens_bert to db")
+        self.update(engine, df, table, columns, self.output_dir)
+
+    def write_docs(self, docs_file, index_writer: pq.ParquetWriter, index_tables: list, ids: list,
+                   doc_bin_bytes: bytes) -> None:
+        """Appends the serialized DocBin to the docs file and adds the location of each of its docs to the index"""
+        offset = docs_file.tell()
+        docs_file.write(doc_bin_bytes)
+        num_docs = len(ids)
+        arrays = [pa.array(ids, type=pa.int64()),
+                  pa.array([offset] * num_docs, type=pa.int64()),
+                  pa.array([len(doc_bin_bytes)] * num_docs, type=pa.int64()),
+                  pa.array(range(num_docs), type=pa.int32())]
+        index_tables.append(pa.Table.from_arrays(arrays, schema=self.spacy_index_schema))
+        if sum(table.num_rows for table in index_tables) >= self.spacy_index_row_group_size:
+            self.flush_index(index_writer, index_tables)
+
+    def flush_index(self, index_writer: pq.ParquetWriter, index_tables: list) -> None:
+        """Writes the buffered index tables as one big row group and empties the buffer"""
+        if index_tables:
+            index_table = pa.concat_tables(index_tables).combine_chunks()
+            index_writer.write_table(index_table, row_group_size=self.spacy_index_row_group_size)
+            index_tables.clear()
+
+    def load_docs(self, spacy_dir: Path, ids: list, spacy_vocab: Vocab):
+        """
+        Lazily loads the docs with the given ids from the docs.spacy files in the spacy_dir,
+        so that only the docs of one DocBin are in memory at the same time.
+        The DocBins carry the strings of their docs, so no saved vocab is needed (an empty Vocab() is enough)
+        :return:    a generator of (id, doc) tuples (grouped by DocBin, not in the order of the ids)
+        """
+        if spacy_dir not in self.spacy_docs_index:
+            self.spacy_docs_index[spacy_dir] = self.build_docs_index(spacy_dir)
+        docs_index = self.spacy_docs_index[spacy_dir]
+
+        doc_bin_locations = {}  # only read and deserialize each of the needed DocBins once per call
+        for id in ids:
+            if id not in docs_index:
+                raise ValueError(f"The spacy doc of the id {id} is missing in the index of {spacy_dir}. "
+                                 f"Please rerun the spacy pipeline (the old <id>.spacy files are not supported anymore)")
+            path, offset, length, position = docs_index[id]
+            doc_bin_locations.setdefault((path, offset, length), {})[position] = id
+
+        for (path, offset, length), ids_by_position in doc_bin_locations.items():
+            doc_bin = self.read_doc_bin(path, offset, length)
+            # stop creating docs after the last needed one instead of going through the whole DocBin
+            docs = islice(doc_bin.get_docs(spacy_vocab), max(ids_by_position) + 1)
+            for position, doc in enumerate(docs):
+                if position in ids_by_position:
+                    yield ids_by_position[position], doc
+
+    @staticmethod
+    def read_doc_bin(path: Path, offset: int, length: int) -> DocBin:
+        """Reads and deserializes one DocBin of a docs.spacy file"""
+        with path.open("rb") as docs_file:
+            docs_file.seek(offset)
+            return DocBin().from_bytes(docs_file.read(length))
+
+    @staticmethod
+    def build_docs_index(spacy_dir: Path) -> dict:
+        """
+        Maps the doc ids to their location (path, offset, length, position) by reading the index files in batches.
+        The spacy_dir can either be the folder of one part or contain the folders of many parts
+        """
+        docs_index = {}
+        for index_path in spacy_dir.glob("**/index.parquet"):
+            docs_path = index_path.parent / "docs.spacy"
+            for batch in pq.ParquetFile(index_path).iter_batches(batch_size=65536):
+                docs_index.update((id, (docs_path, offset, length, position))
+                                  for id, offset, length, position in zip(*batch.to_pydict().values()))
+        return docs_index
 
     def get_tokenizers(self, lang):
         os.environ['TOKENIZERS_PARALLELISM'] = "True"
@@ -313,35 +498,48 @@ class AbstractPreprocessor:
         dfs = self.select(engine, table, columns='id', where=where)  # stream dfs from the db
         for df in dfs:
             ids = df.id.to_list()
-            logger.info(f"Loading {len(ids)} spacy docs")  # load
-            docs = [Doc(spacy_vocab).from_disk(spacy_dir / (str(id) + ".spacy"), exclude=['tensor'])
-                    for id in ids]
+            logger.info(f"Computing the counters for {len(ids)} spacy docs")
+            counters = {counter_type: {} for counter_type in self.counter_types}
+            # compute all the counters in one pass, so that the docs can be streamed instead of kept in memory
+            for id, doc in tqdm(self.load_docs(spacy_dir, ids, spacy_vocab), total=len(ids)):  # load
+                for counter_type in self.counter_types:  # map
+                    counters[counter_type][id] = self.create_counter_for_doc(doc, counter_type)
             for counter_type in self.counter_types:
-                logger.info(f"Computing the counters for type {counter_type}")  # map
-                counter_type_list = [counter_type] * len(docs)
-                df[counter_type] = tqdm(map(self.create_counter_for_doc, docs, counter_type_list), total=len(ids))
+                df[counter_type] = [counters[counter_type][id] for id in ids]
             self.update(engine, df, table, self.counter_types, self.output_dir)  # save
-        gc.collect()
-        sleep(2)  # sleep(2) is required to allow measurement of the garbage collector
+        trim_memory()
 
     def create_counter_for_doc(self, doc: spacy.tokens.Doc, counter_type, filter_stops=False) -> dict:
         """
         take lemma without underscore for faster computation (int instead of str)
+        The tokens are counted with numpy on the attribute arrays, so that the strings only need to be looked up
+        (and filtered) for the distinct values instead of for every token
         """
         if counter_type == 'counter_lemma':
-            # take casefold of lemma to remove capital letters and ß
-            lemmas = [token.lemma_.casefold() for token in doc if token.pos_ not in ['NUM', 'PUNCT', 'SYM', 'X']]
-            # only take alphanumeric lemmas to filter out digits
-            lemmas = [lemma for lemma in lemmas if lemma.isalpha()]
-            if filter_stops:  # don't do this at the moment because it can still be done later if needed
+            lemmas, poses = doc.to_array([LEMMA, POS]).T
+            lemmas = lemmas[~np.isin(poses, [NUM, PUNCT, SYM, X])]
+            counter = Counter()
+            for lemma, count in self.count_attribute_values(doc, lemmas).items():
+                # take casefold of lemma to remove capital letters and ß
+                lemma = lemma.casefold()
+                # only take alphanumeric lemmas to filter out digits
+                if not lemma.isalpha():
+                    continue
+                # don't do this at the moment because it can still be done later if needed
                 # filter out stopwords (spacy is_stop filtering does not work well)
-                lemmas = [lemma for lemma in lemmas if lemma not in self.stopwords]
-            return dict(Counter(lemmas))
+                if filter_stops and lemma in self.stopwords:
+                    continue
+                counter[lemma] += count
+            return dict(counter)
         elif counter_type == 'counter_pos':
-            poses = [token.pos_ for token in doc]
-            return dict(Counter(poses))
+            return self.count_attribute_values(doc, doc.to_array(POS))
         elif counter_type == 'counter_tag':
-            tags = [token.tag_ for token in doc]
-            return dict(Counter(tags))
+            return self.count_attribute_values(doc, doc.to_array(TAG))
         else:
             raise ValueError(f"You chose counter_type {counter_type}. Please choose one of {self.counter_types}.")
+
+    @staticmethod
+    def count_attribute_values(doc: spacy.tokens.Doc, values: np.ndarray) -> dict:
+        """Counts the attribute values (hashes or symbols) of the tokens and returns them as strings"""
+        unique_values, counts = np.unique(values, return_counts=True)
+        return {doc.vocab.strings[int(value)]: int(count) for value, count in zip(unique_values, counts)}
@@ -1,5 +1,7 @@
 import configparser
 
+from spacy.vocab import Vocab
+
 from scrc.preprocessors.abstract_preprocessor import AbstractPreprocessor
 from root import ROOT_DIR
 from scrc.utils.log_utils import get_logger
@@ -48,7 +50,7 @@ class CountComputer(AbstractPreprocessor):
 
         if chambers:
             self.logger.info("Computing the counters for individual decisions")
-            self.spacy_vocab = self.load_vocab(self.lang_dir)
+            self.spacy_vocab = Vocab()  # the DocBins carry their own strings
 
             for chamber in chambers:
                 self.logger.info(f"Processing chamber {chamber}")
@@ -1,10 +1,10 @@
 import glob
 from pathlib import Path
 
-import spacy
 from tqdm import tqdm
 
 import pandas as pd
+from spacy.vocab import Vocab
 
 from scrc.preprocessors.abstract_preprocessor import AbstractPreprocessor
 from scrc.utils.log_utils import get_logger
@@ -34,28 +34,30 @@ class ExternalCorpusProcessor(AbstractPreprocessor):
         engine = self.get_engine(self.db)
         self.extract_to_db(engine)
 
-        disable_pipes = ['senter', 'ner', 'attribute_ruler', 'textcat']
-        nlp = spacy.load('de_core_news_lg', disable=disable_pipes)
-        nlp.max_length = 3000000
+        model_name = 'de_core_news_lg'
+        nlp = self.load_spacy_model(model_name, self.logger)
 
         self.logger.info("Running spacy pipeline")
         assert isinstance(self.subdir, Path)
         assert isinstance(self.spacy_subdir, Path)
-        processed_file_path = self.subdir / f"{self.tables_name}_spacied.txt"
+        # the docs used to be saved as one file per doc, so the parts processed like that are spacied again
+        processed_file_path = self.subdir / f"{self.tables_name}_spacied_doc_bins.txt"
         parts, message = self.compute_remaining_parts(processed_file_path, self.tables)
         self.logger.info(message)
-        for part in parts:
-            part_dir = self.create_dir(self.spacy_subdir, part)
-            self.run_nlp_pipe(engine, part, part_dir, "", nlp, None, self.logger)
-            self.mark_as_processed(processed_file_path, part)
+        if parts:
+            with self.create_spacy_pool(model_name, None, self.logger) as pool:
+                for part in parts:
+                    # saves the docs to spacy_subdir/part
+                    self.run_nlp_pipe(engine, part, self.spacy_subdir, part, "", nlp, None, self.logger, pool)
+                    self.mark_as_processed(processed_file_path, part)
 
         self.logger.info("Computing counters")
         processed_file_path = self.subdir / f"parts_counted.txt"
         parts, message = self.compute_remaining_parts(processed_file_path, self.tables)
         self.logger.info(message)
+        spacy_vocab = Vocab()  # the DocBins carry their own strings
         for part in parts:
             part_dir = self.spacy_subdir / part
-            spacy_vocab = self.load_vocab(part_dir)
             self.compute_counters(engine, part, "", spacy_vocab, part_dir, self.logger)
             self.mark_as_processed(processed_file_path, part)
 
@@ -39,6 +39,12 @@ class AbstractExtractor(ABC, AbstractPreprocessor):
         e.g. data is required to be present for analysis"""
         return True
 
+    def get_condition_mask(self, df: pd.DataFrame) -> Optional[pd.Series]:
+        """Override to check the condition before processing for an entire df at once (much faster than row by row).
+        Only the rows inside the mask are processed and check_condition_before_process is skipped for them.
+        If None, check_condition_before_process is called for every row"""
+        return None
+
     def __init__(self, config: dict, function_name: str, col_name: str, col_type: str = 'jsonb'):
         super().__init__(config)
         self.logger = get_logger(__name__)
@@ -91,7 +97,16 @@ class AbstractExtractor(ABC, AbstractPreprocessor):
             dfs = self.select(engine, lang, where=where,
                               chunksize=self.chunksize)
             for df in dfs:
-                df = df.apply(self.process_one_df_row, axis="columns")
+                mask = self.get_condition_mask(df)
+                if mask is None:  # the condition is checked row by row
+                    df = df.apply(self.process_one_df_row, axis="columns")
+                elif mask.all():  # nothing to skip, so process the whole df without masking it
+                    df = df.apply(self.process_one_df_row, axis="columns", condition_checked=True)
+                else:
+                    df[self.col_name] = None
+                    if mask.any():
+                        processed_df = df[mask].apply(self.process_one_df_row, axis="columns", condition_checked=True)
+                        df.loc[mask, self.col_name] = processed_df[self.col_name]
                 self.update(engine, df, lang, [self.col_name], self.output_dir)
                 self.log_progress(self.chunksize)
 
@@ -99,21 +114,22 @@ class AbstractExtractor(ABC, AbstractPreprocessor):
 
         self.logger.info(f"{self.logger_info['finish_spider']} {spider}")
 
-    def process_one_df_row(self, series: pd.DataFrame) -> pd.DataFrame:
-        """Processes one row of a raw df"""
+    def process_one_df_row(self, series: pd.DataFrame, condition_checked: bool = False) -> pd.DataFrame:
+        """Processes one row of a raw df (condition_checked if the row is inside the condition mask already)"""
         self.logger.debug(f"{self.logger_info['processing_one']} {series['file_name']}")
         namespace = series[["date", "html_url", "id"]].to_dict()
         namespace['language'] = Language(series['language'])
         data = self.get_required_data(series)
         assert data
         series[self.col_name] = self.call_processing_function(
-            series["spider"], data, namespace
+            series["spider"], data, namespace, condition_checked
         )
         return series
 
-    def call_processing_function(self, spider: str, data: Any, namespace: dict) -> Optional[Any]:
+    def call_processing_function(self, spider: str, data: Any, namespace: dict,
+                                 condition_checked: bool = False) -> Optional[Any]:
         """Calls the processing function (named by the spider) and passes the data and the namespace as arguments."""
-        if not self.check_condition_before_process(spider, data, namespace):
+        if not condition_checked and not self.check_condition_before_process(spider, data, namespace):
             return None
         extracting_functions = getattr(self.processing_functions, spider)
         try:
@@ -6,6 +6,7 @@ from scrc.utils.main_utils import get_config
 
 if TYPE_CHECKING:
     from pandas.core.frame import DataFrame
+    from pandas.core.series import Series
 
 
 class LowerCourtExtractor(AbstractExtractor):
@@ -41,6 +42,10 @@ class LowerCourtExtractor(AbstractExtractor):
         e.g. data is required to be present for analysis"""
         return bool(data)
 
+    def get_condition_mask(self, df: DataFrame) -> Series:
+        """Only the rows with a header are processed (replaces check_condition_before_process for the whole df)"""
+        return df['header'].notna() & (df['header'].str.len() > 0)
+
 
 if __name__ == '__main__':
     config = get_config()
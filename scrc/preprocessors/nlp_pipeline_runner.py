@@ -2,7 +2,6 @@ import sys
 from memory_profiler import profile
 import os, psutil
 
-import spacy
 import configparser
 from scrc.preprocessors.abstract_preprocessor import AbstractPreprocessor
 from root import ROOT_DIR
@@ -42,15 +41,9 @@ class NlpPipelineRunner(AbstractPreprocessor):
             'fr': 'fr_core_news_lg',
             'it': 'it_core_news_lg'
         }
-        # tag, pos and lemma are enough for now
-        self.disable_pipes = ['senter', 'ner', 'attribute_ruler', 'textcat']
         self.active_spacy_model = None
         self.active_bert_tokenizer = None
 
-    @staticmethod
-    def load_spacy_model(model_name, disable_pipes):
-        return spacy.load(model_name, disable=disable_pipes)
-
     def run_pipeline(self):
         self.logger.info("Started running spacy pipeline on the texts")
 
@@ -58,47 +51,46 @@ class NlpPipelineRunner(AbstractPreprocessor):
             self.logger.info(f"Started processing language {lang}")
             lang_dir = self.create_dir(self.spacy_subdir, lang)  # output dir
 
-            processed_file_path = self.progress_dir / f"{lang}_spiders_spacied.txt"
+            # the docs used to be saved as one file per doc, so the spiders processed like that are spacied again
+            processed_file_path = self.progress_dir / f"{lang}_spiders_spacied_doc_bins.txt"
             spider_list, message = self.compute_remaining_spiders(processed_file_path)
             self.logger.info(message)
 
-            if spider_list:
-                self.load_language_models(lang, lang_dir)
-
             engine = self.get_engine(self.db_scrc)
             # add new columns for num_tokens
             self.add_column(engine, lang, col_name='num_tokens_spacy', data_type='bigint')
             self.add_column(engine, lang, col_name='num_tokens_bert', data_type='bigint')
 
-            for spider in spider_list:
-                # according to docs you should aim for a partition size of 100MB
-                # 1 court decision takes approximately between around 10KB and 100KB of RAM when loaded into memory
-                # The spacy doc takes about 25x the size of a court decision
-                self.run_nlp_pipeline(engine, spider, lang, lang_dir)
-                self.mark_as_processed(processed_file_path, spider)
+            if spider_list:
+                self.load_language_models(lang)
+                # the workers of the pool load the model once and are reused for all the spiders of this language
+                with self.create_spacy_pool(self.models[lang], self.active_bert_tokenizer, self.logger) as pool:
+                    for spider in spider_list:
+                        # according to docs you should aim for a partition size of 100MB
+                        # 1 court decision takes approximately between around 10KB and 100KB of RAM when loaded into memory
+                        # The spacy doc takes about 25x the size of a court decision
+                        self.run_nlp_pipeline(engine, spider, lang, lang_dir, pool)
+                        self.mark_as_processed(processed_file_path, spider)
 
             self.logger.info(f"Finished processing language {lang}")
 
         self.logger.info("Finished running spacy pipeline on the texts")
 
-    def load_language_models(self, lang, lang_dir):
+    def load_language_models(self, lang):
         self.logger.info("Loading spacy model")
-        self.active_spacy_model = self.load_spacy_model(self.models[lang], self.disable_pipes)
-        # increase max length for long texts: Can lead to memory allocation errors for parser and ner
-        self.active_spacy_model.max_length = 3000000
-        self.active_spacy_model.vocab = self.load_vocab(lang_dir)
+        self.active_spacy_model = self.load_spacy_model(self.models[lang], self.logger)
 
         # calculate both the num_tokens for regular words and subwords
         spacy_tokenizer, self.active_bert_tokenizer = self.get_tokenizers(lang)
 
     @profile
-    def run_nlp_pipeline(self, engine, spider, lang, lang_dir):
+    def run_nlp_pipeline(self, engine, spider, lang, lang_dir, pool):
         """
         Creates and saves the docs generated by the spacy pipeline.
         """
         self.logger.info(f"Processing spider {spider}")
 
-        self.run_nlp_pipe(engine, lang, lang_dir, f"spider='{spider}'", self.active_spacy_model, self.active_bert_tokenizer, self.logger)
+        self.run_nlp_pipe(engine, lang, lang_dir, spider, f"spider='{spider}'", self.active_spacy_model, self.active_bert_tokenizer, self.logger, pool)
 
         memory_usage = psutil.Process(os.getpid()).memory_info().rss / 1024 ** 3
         message = f"Your running process is currently using {memory_usage:.3f} GB of memory"
@@ -0,0 +1,54 @@
+import hashlib
+import sqlite3
+from pathlib import Path
+
+from spacy.tokens import DocBin
+
+
+class DocCache:
+    """
+    Caches the serialized spacy docs by the hash of their text and the model that processed them.
+    Like this, texts occurring many times (e.g. templated decisions) only need to go through the spacy pipe once.
+    Every process opens its own connection, the sqlite database can be shared by all the workers.
+    """
+
+    def __init__(self, path: Path, model_version: str, doc_bin_attrs: list):
+        self.model_version = model_version.encode()
+        self.doc_bin_attrs = doc_bin_attrs
+        self.connection = sqlite3.connect(str(path), timeout=600)
+        self.connection.execute("PRAGMA journal_mode=WAL")  # allows reading while another worker is writing
+        self.connection.execute("CREATE TABLE IF NOT EXISTS docs (key BLOB PRIMARY KEY, doc_bin BLOB)")
+        self.connection.commit()
+        self.new_entries = []
+
+    @staticmethod
+    def get_model_version(nlp, pretokenize: bool) -> str:
+        """The docs depend on the model, its enabled pipes and the tokenization"""
+        meta = nlp.meta
+        return f"{meta['lang']}_{meta['name']}-{meta['version']}:{','.join(nlp.pipe_names)}:{pretokenize}"
+
+    def get_key(self, text: str) -> bytes:
+        blake = hashlib.blake2b(self.model_version, digest_size=16)
+        blake.update(text.encode())
+        return blake.digest()
+
+    def get_docs(self, keys: list, vocab) -> dict:
+        """Returns the cached docs for the given keys (the keys not in the cache are missing)"""
+        if not keys:
+            return {}
+        placeholders = ", ".join("?" * len(keys))
+        rows = self.connection.execute(f"SELECT key, doc_bin FROM docs WHERE key IN ({placeholders})", keys)
+        return {key: next(DocBin().from_bytes(doc_bin).get_docs(vocab)) for key, doc_bin in rows}
+
+    def add_doc(self, key: bytes, doc) -> None:
+        """Adds the doc (as a DocBin of its own) to the entries saved with the next commit"""
+        doc_bin = DocBin(attrs=self.doc_bin_attrs, store_user_data=False, docs=[doc])
+        self.new_entries.append((key, doc_bin.to_bytes()))
+
+    def commit(self) -> None:
+        self.connection.executemany("INSERT OR IGNORE INTO docs (key, doc_bin) VALUES (?, ?)", self.new_entries)
+        self.connection.commit()
+        self.new_entries = []
+
+    def close(self) -> None:
+        self.connection.close()
@@ -1,9 +1,16 @@
+import ctypes
+import functools
 import json
+import os
+import queue
 import re
+import threading
 import unicodedata
 from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 import configparser
 from os.path import exists
+from pathlib import Path
 from root import ROOT_DIR
 import pandas as pd
 
@@ -82,6 +89,78 @@ def chunker(iterable, chunk_size):
     return (iterable[pos: pos + chunk_size] for pos in range(0, len(iterable), chunk_size))
 
 
+def prefetch(iterable, max_size=4):
+    """
+    Consumes the iterable in a background thread, so that producing the next items (e.g. reading from disk or db)
+    overlaps with processing the current ones in the calling thread
+    :param iterable:    the iterable to consume
+    :param max_size:    the maximum number of items buffered in advance
+    :return:            a generator yielding the same items as the iterable
+    """
+    items = queue.Queue(maxsize=max_size)
+    stop = threading.Event()
+    end = object()  # marks that the iterable is exhausted
+
+    def produce():
+        try:
+            for item in iterable:
+                while not stop.is_set():
+                    try:
+                        items.put(item, timeout=1)
+                        break
+                    except queue.Full:
+                        pass
+                if stop.is_set():  # the consumer stopped early
+                    return
+        finally:
+            items.put(end)
+
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        future = executor.submit(produce)
+        try:
+            item = items.get()
+            while item is not end:
+                yield item
+                item = items.get()
+            future.result()  # raises the exceptions of the producer
+        finally:
+            stop.set()
+            while not future.done():  # make room for the end marker so that the producer can finish
+                try:
+                    items.get(timeout=1)
+                except queue.Empty:
+                    pass
+
+
+def get_num_cpus() -> int:
+    """
+    Returns the number of cpus this process may actually use.
+    Unlike os.cpu_count() this respects the cpu affinity (e.g. set by slurm or taskset) and the cgroup (v2) cpu quota
+    """
+    try:
+        num_cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # not available on macOS and Windows
+        num_cpus = os.cpu_count()
+    try:
+        quota, period = Path('/sys/fs/cgroup/cpu.max').read_text().split()
+        if quota != 'max':
+            num_cpus = min(num_cpus, max(1, int(quota) // int(period)))
+    except (OSError, ValueError):
+        pass  # no cgroup v2 cpu quota
+    return num_cpus
+
+
+def trim_memory() -> None:
+    """
+    Returns the freed heap memory of this process to the os.
+    Unlike gc.collect() this really shrinks the rss, but it only works with glibc.
+    """
+    try:
+        ctypes.CDLL('libc.so.6').malloc_trim(0)
+    except (OSError, AttributeError):
+        logger.debug("Could not trim the memory because glibc is not available")
+
+
 def get_file_gen(path):
     def get_path(path, chunk):
         return path / f"part.{chunk}.parquet"
@@ -183,8 +262,9 @@ def get_legal_area(chamber: str):
     raise ValueError(f"Please provide a valid chamber name. Could not find {chamber} in {legal_areas}")
 
 
+@functools.lru_cache(maxsize=1)
 def get_config() -> configparser.ConfigParser:
-    """Returns the parsed `config.ini` / `rootconfig.ini` files"""
+    """Returns the parsed `config.ini` / `rootconfig.ini` files (only parsed once per process, do not modify it)"""
     config = configparser.ConfigParser()
     config.read(ROOT_DIR / 'config.ini')  # this stops working when the script is called from the src directory!
     if exists(ROOT_DIR / 'rootconfig.ini'):
@@ -0,0 +1,111 @@
+"""
+Functions used by the worker processes of the spacy pool.
+Every worker loads the spacy model only once in the initializer and can then process batches
+of many different parts, instead of getting a new copy of the model for every call to nlp.pipe.
+"""
+import os
+
+import spacy
+from spacy.tokens import Doc, DocBin
+from threadpoolctl import threadpool_limits
+from tokenizers.pre_tokenizers import Whitespace
+
+from scrc.utils.doc_cache import DocCache
+
+# only store the attributes computed by the enabled pipes (no parser and ner) and no user data
+doc_bin_attrs = ["ORTH", "TAG", "LEMMA", "MORPH", "POS"]
+
+pre_tokenizer = Whitespace()
+
+# the state of the worker process (set by init_worker)
+worker_nlp = None
+worker_bert_tokenizer = None
+worker_batch_size = None
+worker_doc_cache = None
+
+
+def init_worker(model_name: str, disable_pipes: list, max_length: int, tokenizer, pipe_batch_size: int,
+                use_pretokenizer: bool, doc_cache_path):
+    """Loads the spacy model (and sets the bert tokenizer) into the globals of the worker process"""
+    import torch  # only imported by the workers, so that the other entrypoints importing this module do not need it
+
+    global worker_nlp, worker_bert_tokenizer, worker_batch_size, worker_doc_cache
+    # every worker is its own process already, so multithreading inside the workers would oversubscribe the cpus
+    # the env vars of the thread pools are only read on import (which happened before the fork), so limit them directly
+    os.environ['TOKENIZERS_PARALLELISM'] = "false"
+    threadpool_limits(1)
+    torch.set_num_threads(1)
+    worker_nlp = spacy.load(model_name, disable=disable_pipes)
+    worker_nlp.max_length = max_length
+    if use_pretokenizer:
+        set_pretokenizer(worker_nlp)
+    worker_bert_tokenizer = tokenizer
+    worker_batch_size = pipe_batch_size
+    if doc_cache_path:
+        model_version = DocCache.get_model_version(worker_nlp, use_pretokenizer)
+        worker_doc_cache = DocCache(doc_cache_path, model_version, doc_bin_attrs)
+
+
+def process_batch(batch: tuple) -> tuple:
+    """Processes one (ids, texts) batch with the spacy model of this worker"""
+    ids, texts = batch
+    return pipe_batch(worker_nlp, worker_bert_tokenizer, ids, texts, worker_batch_size, worker_doc_cache)
+
+
+def create_pretokenized_doc(vocab, text: str) -> Doc:
+    """Creates a doc with the tokens of the (much faster) rust whitespace pre tokenizer of huggingface"""
+    tokens = pre_tokenizer.pre_tokenize_str(text)
+    words = [word for word, _ in tokens]
+    spaces = [text[end:end + 1].isspace() for _, (_, end) in tokens]
+    return Doc(vocab, words=words, spaces=spaces)
+
+
+def set_pretokenizer(nlp) -> None:
+    """Replaces the spacy tokenizer by the huggingface whitespace pre tokenizer (nlp.pipe still gets the texts)"""
+    nlp.tokenizer = lambda text: create_pretokenized_doc(nlp.vocab, text)
+
+
+def pipe_batch(nlp, bert_tokenizer, ids, texts, batch_size, doc_cache=None) -> tuple:
+    """
+    Runs the spacy pipe on the texts and packs the docs into a DocBin
+    :param nlp:             the spacy model
+    :param bert_tokenizer:  used for computing the number of bert tokens if present
+    :param ids:             the ids of the texts
+    :param texts:           the texts to process
+    :param batch_size:      the batch size used for nlp.pipe
+    :param doc_cache:       if given, only the texts which are not in the cache are processed
+    :return:                the ids, the num_tokens_spacy, the num_tokens_bert and the serialized DocBin
+                            (the cached docs come first, so the ids are not necessarily in the given order)
+    """
+    # the DocBin does not store the tensor and shares the strings between the docs which saves lots of space
+    doc_bin = DocBin(attrs=doc_bin_attrs, store_user_data=False)
+    doc_ids, doc_texts, num_tokens_spacy = [], [], []
+
+    def add_doc(id, text, doc):
+        doc_bin.add(doc)
+        doc_ids.append(id)
+        doc_texts.append(text)
+        num_tokens_spacy.append(len(doc))
+
+    keys = [doc_cache.get_key(text) for text in texts] if doc_cache else [None] * len(texts)
+    cached_docs = doc_cache.get_docs(keys, nlp.vocab) if doc_cache else {}
+    missing = []
+    for id, text, key in zip(ids, texts, keys):
+        if key in cached_docs:
+            add_doc(id, text, cached_docs[key])
+        else:
+            missing.append((id, text, key))
+
+    missing_texts = [text for _, text, _ in missing]
+    for (id, text, key), doc in zip(missing, nlp.pipe(missing_texts, batch_size=batch_size)):
+        add_doc(id, text, doc)
+        if doc_cache:
+            doc_cache.add_doc(key, doc)
+    if doc_cache:
+        doc_cache.commit()
+
+    if bert_tokenizer:
+        num_tokens_bert = [len(input_id) for input_id in bert_tokenizer(doc_texts).input_ids]
+    else:
+        num_tokens_bert = [None] * len(doc_ids)
+    return doc_ids, num_tokens_spacy, num_tokens_bert, doc_bin.to_bytes()